@@ -1,75 +1,125 @@
-from flask import Blueprint, render_template, request
+from flask import Blueprint, Response, render_template, request
 
 main = Blueprint('main', __name__)
 
-import requests
+import requests, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import folium
-from shapely.geometry import Polygon, MultiPolygon
-from shapely.ops import transform, unary_union
-from pyproj import CRS, Transformer
+import numpy as np
+from pyproj import Geod
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
-from functools import wraps
+import shapely
+import shapely.wkb
+import hashlib
+import os
+import orjson
+import redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry as RedisRetry
 
 import logging
 
 logging.basicConfig(level=logging.INFO)
-logging.getLogger("urllib3").setLevel(logging.DEBUG)
-
-def with_retry_session(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        session = requests.Session()
-        retry = Retry(
-            total=3,
-            backoff_factor=1,
-            status_forcelist=[500, 502, 503, 504, 429],
-            allowed_methods=["POST"],
-            raise_on_status=False
-        )
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount("http://", adapter)
-        session.mount("https://", adapter)
-        kwargs['session'] = session
-        return func(*args, **kwargs)
-    return wrapper
-
-def get_metro_station_names(city_name):
+log = logging.getLogger(__name__)
+
+_retry = Retry(
+    total=3,
+    backoff_factor=1,
+    status_forcelist=[500, 502, 503, 504, 429],
+    allowed_methods=["POST"],
+    raise_on_status=False
+)
+_adapter = HTTPAdapter(max_retries=_retry, pool_connections=20, pool_maxsize=20)
+
+# Shared session so every Overpass call reuses pooled keep-alive connections
+_SESSION = requests.Session()
+_SESSION.mount("http://", _adapter)
+_SESSION.mount("https://", _adapter)
+_SESSION.headers["Accept-Encoding"] = "gzip"
+
+
+def get_session():
+    """Return the module-level pooled requests.Session."""
+    return _SESSION
+
+# Overpass results are near-static, so cache them in Redis for a day. The
+# cache is best-effort: short timeouts and no retries keep a Redis outage
+# down to milliseconds per request instead of stalling on connect.
+CACHE_TTL = 86400
+_r = redis.Redis.from_url(
+    os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+    socket_connect_timeout=0.25,
+    socket_timeout=0.25,
+    retry=RedisRetry(NoBackoff(), 0),
+)
+
+
+def _cache_get(key):
+    """Return the cached bytes for key, or None on a miss or if Redis is down."""
+    try:
+        return _r.get(key)
+    except redis.RedisError:
+        return None
+
+
+def _cache_set(key, value, ttl=CACHE_TTL):
+    """Store value under key, ignoring Redis outages."""
+    try:
+        _r.set(key, value, ex=ttl)
+    except redis.RedisError:
+        pass
+
+# Overpass QL templates, built once with no incidental whitespace so the
+# rendered query (and therefore its cache key) is stable across code edits
+_STATION_NAMES_Q = (
+    '[out:csv(name;false)][timeout:25];'
+    'area["name:en"="{city}"]["boundary"="administrative"]->.searchArea;'
+    'node["railway"="station"]["station"="subway"](area.searchArea);'
+    'out tags;'
+)
+_STATION_LOCATION_Q = (
+    '[out:json][timeout:25];'
+    'area{city_filter}->.searchArea;'
+    '('
+    'node["railway"="station"]["station"="subway"]["name"="{station}"](area.searchArea);'
+    'node["railway"="station"]["station"="subway"]["name:en"="{station}"](area.searchArea);'
+    ');'
+    'out body;'
+)
+_PARKING_SURFACE_Q = (
+    '[out:json][timeout:90];'
+    '(way["amenity"="parking"]["parking"="surface"](around:{radius},{lat},{lon}););'
+    'out {verbosity} geom;'
+)
+_PARKING_OPEN_Q = (
+    '[out:json][timeout:90];'
+    '(way["amenity"="parking"]["parking"!="multi-storey"]["parking"!="lane"]'
+    '["parking"!="street_side"]["parking"!="underground"]["covered"!="yes"]'
+    '(around:{radius},{lat},{lon}););'
+    'out {verbosity} geom;'
+)
+
+def get_metro_station_names(city_name, session=_SESSION):
     """
     Queries Overpass API for all metro (subway) station names in the given city.
 
     Args:
         city_name (str): The name of the city to query.
+        session (requests.Session, optional): Session used for the request.
 
     Returns:
         List[str]: Sorted list of unique metro station names.
     """
-    overpass_url = "http://overpass-api.de/api/interpreter"
+    query = _STATION_NAMES_Q.format(city=city_name)
 
-    query = f"""
-    [out:json][timeout:25];
-    area["name:en"="{city_name}"]["boundary"="administrative"]->.searchArea;
-    node["railway"="station"]["station"="subway"](area.searchArea);
-    out body;
-    """
-
-    response = requests.post(overpass_url, data={'data': query})
-    response.raise_for_status()  # Raise exception if request failed
-    data = response.json()
-
-    station_names = {
-        element["tags"]["name"]
-        for element in data["elements"]
-        if "tags" in element and "name" in element["tags"]
-    }
+    # CSV output is one name per line, far smaller than the JSON elements
+    text = overpass_query(query, session, raw=True).decode("utf-8")
+    station_names = {line for line in text.splitlines() if line}
 
     return sorted(station_names)
 
-import requests, time
-from shapely.geometry import Polygon
-from shapely.ops import transform
-from pyproj import CRS, Transformer
-
 
 OVERPASS_URLS = [
     "https://lz4.overpass-api.de/api/interpreter",        # fastest / best success rate
@@ -77,109 +127,171 @@ OVERPASS_URLS = [
     "https://overpass.openstreetmap.fr/api/interpreter",
 ]
 
+# Cap in-flight requests per mirror to stay within the public rate limits
+_OVERPASS_SLOTS = {url: threading.BoundedSemaphore(4) for url in OVERPASS_URLS}
+
+# Overall wait for the fastest mirror before giving up; also used as the
+# per-request timeout, since no single POST can outlive the race
+OVERPASS_DEADLINE = 90
+
+_GEOD = Geod(ellps="WGS84")
+
 
-def overpass_query(query, session: requests.Session):
-    """Try multiple Overpass servers sequentially until one succeeds."""
-    for url in OVERPASS_URLS:
-        try:
-            resp = session.post(url, data={"data": query}, timeout=90)
-            if resp.status_code == 429:    # rate limited
-                time.sleep(3)
+def _post_overpass(url, query, session, done, timeout):
+    """POST query to one mirror, unless the race was settled while waiting for a slot."""
+    with _OVERPASS_SLOTS[url]:
+        if done.is_set():
+            return None
+        return session.post(url, data={"data": query}, timeout=timeout)
+
+
+def overpass_query(query, session: requests.Session = _SESSION, deadline=OVERPASS_DEADLINE,
+                   raw=False):
+    """Query all Overpass servers concurrently and return the first good response.
+
+    Responses are cached in Redis keyed by a hash of the query text. JSON
+    bodies are decoded; pass raw=True to get the bytes (e.g. for [out:csv]).
+    """
+    key = "ovp:" + hashlib.blake2b(query.encode(), digest_size=16).hexdigest()
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached if raw else orjson.loads(cached)
+
+    done = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=len(OVERPASS_URLS))
+    futures = [executor.submit(_post_overpass, url, query, session, done, deadline)
+               for url in OVERPASS_URLS]
+    try:
+        for future in as_completed(futures, timeout=deadline):
+            try:
+                resp = future.result()
+                if resp is None:
+                    continue
+                resp.raise_for_status()
+                data = resp.content if raw else orjson.loads(resp.content)
+            except Exception:
                 continue
-            resp.raise_for_status()
-            return resp.json()
-        except Exception:
-            continue
+            # Overpass reports query timeouts / out-of-memory as a 200 with a
+            # "remark" and partial elements; never return or cache those
+            if not raw and "remark" in data:
+                log.warning("Overpass error from %s: %s", resp.url, data["remark"])
+                continue
+            _cache_set(key, resp.content)
+            return data
+    except FuturesTimeoutError:
+        pass
+    finally:
+        # Don't wait on the slower mirrors; calls still queued for a slot
+        # see the event and skip the POST entirely
+        done.set()
+        executor.shutdown(wait=False, cancel_futures=True)
     raise Exception("All Overpass servers failed or timed out")
 
-def get_parking_lots_polygons(lat, lon, radius=1000, surface=False, session=None):
+def get_parking_lots_polygons(lat, lon, radius=1000, surface=False, session=_SESSION,
+                              include_tags=False):
     """
-    Fetch parking lots near (lat,lon), sequentially expand geometry, compute areas.
+    Fetch parking lots near (lat,lon) with their geometry, compute areas.
     This version is designed to eliminate 429/504 errors.
+    The final result list is cached in Redis with polygons stored as WKB.
+    OSM tags are only requested (and returned) when include_tags is set.
     """
 
-    if session is None:
-        session = requests.Session()
-
-    # --- Phase A: Fast lightweight lookup (center only) ---
-    if surface:
-        selector = f'way["amenity"="parking"]["parking"="surface"](around:{radius},{lat},{lon});'
-    else:
-        selector = (
-            'way["amenity"="parking"]["parking"!="multi-storey"]["parking"!="lane"]'
-            '["parking"!="street_side"]["parking"!="underground"]["covered"!="yes"]'
-            f'(around:{radius},{lat},{lon});'
-        )
-
-    lookup_query = f"""
-    [out:json][timeout:90];
-    (
-      {selector}
-    );
-    out ids center tags;
-    """
+    cache_key = f"park:{lat:.5f}:{lon:.5f}:{radius}:{surface}:{include_tags}"
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return _decode_lots(orjson.loads(cached))
 
-    lookup = overpass_query(lookup_query, session)
+    # Single round trip: tags and full geometry for every matching way
+    template = _PARKING_SURFACE_Q if surface else _PARKING_OPEN_Q
+    # "skel" omits tags from the payload; plain "out geom" would still include them
+    verbosity = "tags" if include_tags else "skel"
+    query = template.format(radius=radius, lat=lat, lon=lon, verbosity=verbosity)
 
-    results = []
+    data = overpass_query(query, session)
 
-    # --- Phase B: Fetch geometry for each result (sequential, low load) ---
-    for el in lookup.get("elements", []):
-        way_id = el["id"]
+    # Lots whose vertex mean lies beyond ~1.1 * radius from the center are
+    # mostly outside the search disc; skip them before any Shapely/Geod work
+    max_dist_sq = (1.1 * radius / 111320.0) ** 2
+    cos_lat = np.cos(np.radians(lat))
 
-        geom_query = f"""
-        [out:json][timeout:60];
-        way({way_id});
-        out geom tags;
-        """
+    # --- cleanup coords, keeping rings with at least 3 distinct vertices ---
+    elements, rings, ring_starts = [], [], [0]
+    for element in data.get("elements", []):
+        if "geometry" not in element:
+            continue
 
-        try:
-            geom_data = overpass_query(geom_query, session)
-        except Exception:
+        geometry = element["geometry"]
+        arr = np.fromiter(
+            (c for pt in geometry for c in (pt["lon"], pt["lat"])),
+            dtype=np.float64, count=2 * len(geometry),
+        ).reshape(-1, 2)
+
+        # Drop consecutive duplicate vertices, then the closing vertex
+        mask = np.concatenate(([True], np.any(arr[1:] != arr[:-1], axis=1)))
+        arr = arr[mask]
+        if len(arr) > 2 and (arr[0] == arr[-1]).all():
+            arr = arr[:-1]
+        if len(arr) < 3:
             continue
 
-        for element in geom_data.get("elements", []):
-            if "geometry" not in element:
-                continue
+        cx, cy = arr.mean(axis=0)
+        if ((cx - lon) * cos_lat) ** 2 + (cy - lat) ** 2 > max_dist_sq:
+            continue
 
-            raw_coords = [(pt["lon"], pt["lat"]) for pt in element["geometry"]]
+        elements.append(element)
+        rings.append(arr)
+        ring_starts.append(ring_starts[-1] + len(arr))
 
-            # --- cleanup coords ---
-            coords = [raw_coords[0]]
-            for pt in raw_coords[1:]:
-                if pt != coords[-1]:
-                    coords.append(pt)
-            if len(coords) > 2 and coords[0] == coords[-1]:
-                coords.pop()
-            if len(coords) < 3:
-                continue
+    results = []
 
-            poly = Polygon(coords)
-            if not poly.is_valid:
-                continue
+    if elements:
+        # --- Build and validate every polygon in one vectorized Shapely call ---
+        flat_lonlat = np.concatenate(rings)
+        ring_index = np.repeat(np.arange(len(elements)), np.diff(ring_starts))
+        polys = shapely.polygons(shapely.linearrings(flat_lonlat, indices=ring_index))
+        valid = shapely.is_valid(polys)
+        n_invalid = len(elements) - int(valid.sum())
+        if n_invalid:
+            log.info("skipped %d invalid polygons of %d", n_invalid, len(elements))
 
-            # --- Compute area using UTM ---
-            try:
-                lon_c, lat_c = poly.centroid.x, poly.centroid.y
-                zone = int((lon_c + 180) / 6) + 1
-                epsg = (32600 + zone) if lat_c >= 0 else (32700 + zone)
-                proj = Transformer.from_crs("EPSG:4326", f"EPSG:{epsg}", always_xy=True).transform
-                area = transform(proj, poly).area
-            except:
-                continue
+        for i in np.flatnonzero(valid):
+            ring = flat_lonlat[ring_starts[i]:ring_starts[i + 1]]
+            element = elements[i]
+
+            # --- Compute ellipsoidal area directly on lon/lat ---
+            area = abs(_GEOD.polygon_area_perimeter(ring[:, 0], ring[:, 1])[0])
 
             results.append({
                 "id": element["id"],
                 "type": element["type"],
-                "coordinates": coords,
+                "coordinates": ring.tolist(),
                 "area_m2": round(area, 2),
                 "tags": element.get("tags", {}),
-                "polygon": poly
+                "polygon": polys[i]
             })
 
+    _cache_set(cache_key, orjson.dumps(_encode_lots(results)))
     return results
 
 
+def _encode_lots(lots):
+    """Make parking lot records JSON-serializable, encoding each polygon as hex WKB."""
+    return [
+        {**{k: v for k, v in lot.items() if k != "polygon"},
+         "polygon_wkb": shapely.wkb.dumps(lot["polygon"], hex=True)}
+        for lot in lots
+    ]
+
+
+def _decode_lots(records):
+    """Inverse of _encode_lots: rebuild Shapely polygons from hex WKB."""
+    lots = []
+    for lot in records:
+        lot["polygon"] = shapely.wkb.loads(lot.pop("polygon_wkb"), hex=True)
+        lots.append(lot)
+    return lots
+
+
 def visualize_multiple_polygons(polygons, numbers=None, zoom_start=15):
     """
     Visualize multiple Shapely Polygons on a folium map, each with a clickable number.
@@ -198,14 +310,18 @@ def visualize_multiple_polygons(polygons, numbers=None, zoom_start=15):
     if len(numbers) != len(polygons):
         raise ValueError("Length of numbers must match number of polygons")
 
-    # Compute a centroid from all polygons to center the map
-    combined = unary_union(polygons)
-    centroid = combined.centroid
-    center = (centroid.y, centroid.x)
+    # Center the map on the overall bounding box of all polygons
+    bounds = shapely.bounds(list(polygons))
+    minx, miny = bounds[:, :2].min(axis=0)
+    maxx, maxy = bounds[:, 2:].max(axis=0)
+    center = ((miny + maxy) / 2, (minx + maxx) / 2)
 
     map = folium.Map(location=center, zoom_start=zoom_start)
 
-    for polygon, label in zip(polygons, numbers):
+    # Drop sub-metre vertices (~1e-5 deg) to shrink the HTML and Leaflet redraw cost
+    simplified = shapely.simplify(list(polygons), 1e-5, preserve_topology=True)
+
+    for polygon, label in zip(simplified, numbers):
         coords = list(polygon.exterior.coords)
         latlon_coords = [(lat, lon) for lon, lat in coords]
 
@@ -220,13 +336,14 @@ def visualize_multiple_polygons(polygons, numbers=None, zoom_start=15):
 
     return map
 
-def get_metro_station_location(station_name, city=None):
+def get_metro_station_location(station_name, city=None, session=_SESSION):
     """
     Query Overpass API to find the coordinates of a metro station by name.
     
     Args:
         station_name (str): Name of the metro station.
         city (str, optional): Name of the city to narrow the search.
+        session (requests.Session, optional): Session used for the request.
         
     Returns:
         list of dict: A list of matching stations with name and coordinates.
@@ -234,23 +351,9 @@ def get_metro_station_location(station_name, city=None):
     # Optional city filter
     city_filter = f'["name:en"="{city}"]' if city else ""
     
-    query = f"""
-    [out:json][timeout:25];
-    area{city_filter}->.searchArea;
-    (
-      node["railway"="station"]["station"="subway"]["name"="{station_name}"](area.searchArea);
-      node["railway"="station"]["station"="subway"]["name:en"="{station_name}"](area.searchArea);
-    );
-    out body;
-    """
-    
-    url = "http://overpass-api.de/api/interpreter"
-    response = requests.post(url, data={'data': query})
-
-    if response.status_code != 200:
-        raise Exception(f"Overpass API error: {response.status_code}")
+    query = _STATION_LOCATION_Q.format(city_filter=city_filter, station=station_name)
     
-    data = response.json()
+    data = overpass_query(query, session)
     results = []
     for element in data.get('elements', []):
         results.append({
@@ -261,6 +364,43 @@ def get_metro_station_location(station_name, city=None):
     
     return results
 
+def get_station_record(station_name, city=None, radius=500, surface=False):
+    """
+    Look up a station and summarize its nearby parking lots, cached in Redis.
+
+    Only the station coordinates and the lot totals are stored here; the lots
+    themselves live in the get_parking_lots_polygons cache, which /map reads
+    with the returned lat/lon.
+
+    Returns:
+        dict | None: {'lat', 'lon', 'total_area_m2', 'lot_count'}, or None
+        if the station could not be found.
+    """
+    key = f"station:{city}:{station_name}:{radius}:{surface}"
+    cached = _cache_get(key)
+    if cached is not None:
+        return orjson.loads(cached)
+
+    # Use get_metro_station_location to fetch lat and lon
+    station_locations = get_metro_station_location(station_name, city)
+    if not station_locations:
+        return None
+
+    # Use the first matching station's lat and lon
+    lat = station_locations[0]['lat']
+    lon = station_locations[0]['lon']
+    log.debug("Using coordinates for %s: (%s, %s)", station_name, lat, lon)
+    parking_lots = get_parking_lots_polygons(lat, lon, radius, surface)
+
+    record = {
+        'lat': lat,
+        'lon': lon,
+        'total_area_m2': sum(lot['area_m2'] for lot in parking_lots),
+        'lot_count': len(parking_lots),
+    }
+    _cache_set(key, orjson.dumps(record))
+    return record
+
 @main.route('/', methods=['GET'])
 def home():
     return render_template('base.html')
@@ -277,22 +417,13 @@ def get_parking_lots():
     city = request.form.get('city')  # Pass the city if needed for filtering
     radius = request.form.get('radius', type=int, default=500)
 
-    # Use get_metro_station_location to fetch lat and lon
-    station_locations = get_metro_station_location(station_name, city)
-    if not station_locations:
+    record = get_station_record(station_name, city, radius)
+    if record is None:
         return {'error': f"Could not find location for station: {station_name}"}, 404
 
-    # Use the first matching station's lat and lon
-    lat = station_locations[0]['lat']
-    lon = station_locations[0]['lon']
-    print(f"Using coordinates for {station_name}: ({lat}, {lon})")
-    # Call the get_parking_lots_polygons function
-    parking_lots = get_parking_lots_polygons(lat, lon, radius)
-
-    # Calculate the total area
-    total_area = sum(lot['area_m2'] for lot in parking_lots)
-    print(f"Total area of parking lots near {station_name}: {total_area} m²")
-    if not parking_lots:
+    total_area = record['total_area_m2']
+    log.debug("Total area of parking lots near %s: %s m²", station_name, total_area)
+    if not record['lot_count']:
         return {'error': f"No parking lots found near {station_name}"}, 404
     # Return the total area as JSON
     return {
@@ -306,17 +437,12 @@ def generate_map():
     city = request.args.get('city')
     radius = request.args.get('radius', default=500, type=int)
 
-    # Use get_metro_station_location to fetch lat and lon
-    station_locations = get_metro_station_location(station_name, city)
-    if not station_locations:
+    record = get_station_record(station_name, city, radius)
+    if record is None:
         return "Error: Could not find location for station.", 404
 
-    # Use the first matching station's lat and lon
-    lat = station_locations[0]['lat']
-    lon = station_locations[0]['lon']
-
-    # Call the get_parking_lots_polygons function
-    parking_lots = get_parking_lots_polygons(lat, lon, radius)
+    # Served from the parking lot cache populated by get_station_record
+    parking_lots = get_parking_lots_polygons(record['lat'], record['lon'], radius)
 
     # Extract polygons and areas for visualization
     poly_area = [(lot['polygon'], lot['area_m2']) for lot in parking_lots]
@@ -326,6 +452,6 @@ def generate_map():
     # Generate the Folium map
     folium_map = visualize_multiple_polygons(polygons, areas)
 
-    # Save the map to an HTML file and return it
-    map_html = folium_map._repr_html_()
-    return map_html
\ No newline at end of file
+    # Render the full map page directly, without the notebook iframe wrapper
+    map_html = folium_map.get_root().render()
+    return Response(map_html, mimetype="text/html")
\ No newline at end of file
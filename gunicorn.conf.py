@@ -0,0 +1,7 @@
+# Handlers spend nearly all their time waiting on Overpass, so use
+# cooperative gevent workers rather than one request per process
+bind = "0.0.0.0:8000"
+workers = 4
+worker_class = "gevent"
+worker_connections = 200
+timeout = 120
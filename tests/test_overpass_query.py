@@ -0,0 +1,106 @@
+import threading
+import time
+
+import orjson
+import pytest
+
+from app import routes
+from app.routes import OVERPASS_URLS, get_session, overpass_query
+
+FAST, SLOW_1, SLOW_2 = OVERPASS_URLS
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, url, data):
+        self.url = url
+        self.content = orjson.dumps(data)
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def mirrors(monkeypatch):
+    """Patch the session so each mirror answers with a configured (delay, body).
+
+    Returns the per-URL config dict, the list of URLs actually POSTed to, and
+    the list of values written to the cache.
+    """
+    config = {}
+    posted = []
+    cached = []
+
+    def post(url, data=None, timeout=None):
+        posted.append(url)
+        delay, body = config[url]
+        time.sleep(delay)
+        return FakeResponse(url, body)
+
+    monkeypatch.setattr(get_session(), "post", post)
+    monkeypatch.setattr(routes, "_cache_get", lambda key: None)
+    monkeypatch.setattr(routes, "_cache_set", lambda key, value, ttl=None: cached.append(value))
+    return config, posted, cached
+
+
+def test_first_good_mirror_wins(mirrors):
+    config, _, cached = mirrors
+    config[FAST] = (0.0, {"elements": ["fast"]})
+    config[SLOW_1] = (0.5, {"elements": ["slow"]})
+    config[SLOW_2] = (0.5, {"elements": ["slow"]})
+
+    start = time.monotonic()
+    assert overpass_query("q-first") == {"elements": ["fast"]}
+    assert time.monotonic() - start < 0.4
+    assert [orjson.loads(v) for v in cached] == [{"elements": ["fast"]}]
+
+
+def test_remark_body_is_skipped_and_not_cached(mirrors):
+    config, _, cached = mirrors
+    config[FAST] = (0.0, {"remark": "runtime error: timeout", "elements": []})
+    config[SLOW_1] = (0.1, {"elements": ["full"]})
+    config[SLOW_2] = (0.5, {"elements": ["full"]})
+
+    assert overpass_query("q-remark") == {"elements": ["full"]}
+    assert [orjson.loads(v) for v in cached] == [{"elements": ["full"]}]
+
+
+def test_all_remarks_raise_without_caching(mirrors):
+    config, _, cached = mirrors
+    for url in OVERPASS_URLS:
+        config[url] = (0.0, {"remark": "runtime error: out of memory", "elements": []})
+
+    with pytest.raises(Exception, match="All Overpass servers failed"):
+        overpass_query("q-all-remarks")
+    assert cached == []
+
+
+def test_deadline_raises(mirrors):
+    config, _, cached = mirrors
+    for url in OVERPASS_URLS:
+        config[url] = (0.5, {"elements": []})
+
+    start = time.monotonic()
+    with pytest.raises(Exception, match="All Overpass servers failed"):
+        overpass_query("q-deadline", deadline=0.1)
+    assert time.monotonic() - start < 0.4
+    assert cached == []
+
+
+def test_queued_post_is_skipped_once_race_is_settled(mirrors, monkeypatch):
+    config, posted, _ = mirrors
+    for url in OVERPASS_URLS:
+        config[url] = (0.0, {"elements": []})
+
+    # Occupy SLOW_1's only slot so its worker is still queued when FAST wins
+    slot = threading.BoundedSemaphore(1)
+    monkeypatch.setitem(routes._OVERPASS_SLOTS, SLOW_1, slot)
+    slot.acquire()
+    try:
+        overpass_query("q-queued")
+    finally:
+        slot.release()
+
+    time.sleep(0.2)  # let the queued worker take the slot and see the event
+    assert SLOW_1 not in posted
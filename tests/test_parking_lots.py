@@ -0,0 +1,81 @@
+import orjson
+import pytest
+
+from app import routes
+from app.routes import get_parking_lots_polygons, get_session
+
+LAT, LON = 48.85, 2.35
+
+
+def _pt(lon, lat):
+    return {"lon": lon, "lat": lat}
+
+
+PAYLOAD = {"elements": [
+    # Square with a repeated vertex and the closing vertex
+    {"type": "way", "id": 1, "geometry": [
+        _pt(2.3500, 48.8500), _pt(2.3505, 48.8500), _pt(2.3505, 48.8500),
+        _pt(2.3505, 48.8505), _pt(2.3500, 48.8505), _pt(2.3500, 48.8500),
+    ]},
+    # Self-intersecting bow-tie near the center
+    {"type": "way", "id": 2, "geometry": [
+        _pt(2.3500, 48.8500), _pt(2.3510, 48.8510), _pt(2.3510, 48.8500),
+        _pt(2.3500, 48.8510), _pt(2.3500, 48.8500),
+    ]},
+    # Way without geometry
+    {"type": "way", "id": 3},
+    # Valid square ~1.5 km away, outside a 500 m radius
+    {"type": "way", "id": 4, "geometry": [
+        _pt(2.3700, 48.8500), _pt(2.3705, 48.8500), _pt(2.3705, 48.8505),
+        _pt(2.3700, 48.8505), _pt(2.3700, 48.8500),
+    ]},
+]}
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, data):
+        self.content = orjson.dumps(data)
+        self.url = "https://overpass.test/api/interpreter"
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def overpass(monkeypatch):
+    """Serve PAYLOAD from every mirror and bypass Redis."""
+    queries = []
+
+    def post(url, data=None, **kwargs):
+        queries.append(data["data"])
+        return FakeResponse(PAYLOAD)
+
+    monkeypatch.setattr(get_session(), "post", post)
+    monkeypatch.setattr(routes, "_cache_get", lambda key: None)
+    monkeypatch.setattr(routes, "_cache_set", lambda *args, **kwargs: None)
+    return queries
+
+
+def test_keeps_only_valid_lots_inside_radius(overpass):
+    lots = get_parking_lots_polygons(LAT, LON, radius=500)
+
+    assert [lot["id"] for lot in lots] == [1]
+    assert lots[0]["coordinates"] == [
+        [2.3500, 48.8500], [2.3505, 48.8500], [2.3505, 48.8505], [2.3500, 48.8505],
+    ]
+    assert lots[0]["area_m2"] == pytest.approx(2040.39, abs=0.01)
+    assert lots[0]["polygon"].is_valid
+    assert lots[0]["tags"] == {}
+    assert all("out skel geom;" in q for q in overpass)
+
+
+def test_larger_radius_keeps_distant_lot(overpass):
+    lots = get_parking_lots_polygons(LAT, LON, radius=2000)
+
+    assert [lot["id"] for lot in lots] == [1, 4]
+    assert lots[1]["coordinates"] == [
+        [2.3700, 48.8500], [2.3705, 48.8500], [2.3705, 48.8505], [2.3700, 48.8505],
+    ]
+    assert lots[1]["area_m2"] == pytest.approx(lots[0]["area_m2"], rel=1e-6)
@@ -0,0 +1,8 @@
+# Patch sockets/ssl before anything imports requests, so Overpass calls
+# yield to other requests instead of blocking the worker
+from gevent import monkey
+monkey.patch_all()
+
+from app import create_app
+
+app = create_app()